@@ -1,4 +1,141 @@
+import codecs
+import io
+import itertools
 import os
+import shutil
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Chunk size for reading input files and buffer size for the output stream.
+# Much larger than io.DEFAULT_BUFFER_SIZE (8 KiB) to keep the syscall count low.
+BUFFER_SIZE = 1 << 20
+
+# Extensions that are always binary; their contents are never collected.
+BINARY_EXTENSIONS = frozenset({
+    '.pyc', '.so', '.bin', '.safetensors', '.pt', '.onnx',
+    '.png', '.jpg', '.jpeg', '.gif', '.ico', '.apk', '.jar', '.zip',
+})
+
+# Directories that are never descended into: VCS metadata, caches, virtualenvs
+# and build output, which can dwarf the actual source tree.
+SKIP_DIRS = frozenset({
+    '.git', '.hg', '.svn', '__pycache__', 'node_modules', '.venv', 'venv',
+    '.mypy_cache', '.pytest_cache', '.tox', 'dist', 'build', '.idea', '.vscode',
+})
+
+# How much of a file is inspected to decide whether it is binary
+SNIFF_SIZE = 8192
+
+
+def _iter_files(parent):
+    """
+    Yields the paths of all files below parent, in the same order os.walk
+    would visit them (a directory's files before its subdirectories).
+    Directories named in SKIP_DIRS are pruned without being listed.
+
+    os.scandir returns the entry type with the directory listing itself,
+    so no extra stat call is needed per entry.
+    """
+    try:
+        entries = os.scandir(parent)
+    except OSError:
+        return  # os.walk silently skips unreadable directories as well
+    subdirs = []
+    with entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if entry.name not in SKIP_DIRS:
+                    subdirs.append(entry.path)
+            elif not entry.is_dir():
+                # Symlinked directories are listed but not descended, like os.walk
+                yield entry.path
+    for subdir in subdirs:
+        yield from _iter_files(subdir)
+
+
+def _looks_binary(chunk):
+    """
+    Guesses whether a file is binary from its first SNIFF_SIZE bytes.
+
+    latin-1 decodes any byte sequence, so without this check binary blobs
+    (images, compiled files, model weights) would be copied in full.
+    """
+    if not chunk:
+        return False
+    if b'\x00' in chunk:
+        return True
+    try:
+        # A chunk may end in the middle of a multi-byte character
+        codecs.getincrementaldecoder('utf-8')().decode(chunk)
+        return False
+    except UnicodeDecodeError:
+        pass
+    suspicious = sum(1 for b in chunk if b > 127 or b < 9)
+    return suspicious / len(chunk) > 0.30
+
+
+def _read_one(file_path, parent_dir):
+    """
+    Reads a single file for collect_files_content.
+
+    Files of up to BUFFER_SIZE bytes are returned already encoded as UTF-8, so
+    the output is written from this (parallel) read. Larger files are only
+    sniffed here; _copy_file streams their body into the output afterwards,
+    so they are still read just once and never held in memory.
+
+    Returns:
+        tuple: The path relative to parent_dir, the encoding the file was read
+               with ('utf-8' or 'latin-1', None for large files), a message or
+               None, and the UTF-8 body bytes (None for large files). If the
+               body should not be copied, the message is written in its place.
+    """
+    relative_path = os.path.relpath(file_path, parent_dir)
+    try:
+        if os.path.splitext(file_path)[1].lower() in BINARY_EXTENSIONS:
+            return relative_path, None, f"[binary file skipped, {os.path.getsize(file_path)} bytes]", None
+        with open(file_path, 'rb') as f:
+            head = f.read(SNIFF_SIZE)
+            if _looks_binary(head):
+                return relative_path, None, f"[binary file skipped, {os.fstat(f.fileno()).st_size} bytes]", None
+            data = head + f.read(BUFFER_SIZE - len(head))
+            if f.read(1):
+                return relative_path, None, None, None # Too large to hold; streamed later
+    except Exception as e:
+        return relative_path, None, f"[Error reading file: {e}]", None
+    try:
+        data.decode('utf-8')
+        return relative_path, 'utf-8', None, data
+    except UnicodeDecodeError:
+        # latin-1 maps every byte, so it is a safe fallback for wider compatibility
+        return relative_path, 'latin-1', None, data.decode('latin-1').encode('utf-8')
+
+
+def _copy_file(file_path, out):
+    """
+    Streams a large file's body into the binary output stream, validating it
+    as UTF-8 on the way. If it turns out not to be UTF-8, the partial copy is
+    truncated away and the file is copied again, transcoded from latin-1.
+
+    Returns:
+        str: The encoding the file was read with ('utf-8' or 'latin-1').
+    """
+    start = out.tell()
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    try:
+        with open(file_path, 'rb') as src:
+            for chunk in iter(lambda: src.read(BUFFER_SIZE), b''):
+                decoder.decode(chunk)
+                out.write(chunk)
+            decoder.decode(b'', final=True)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        pass
+    out.seek(start)
+    out.truncate()
+    with open(file_path, 'rb') as src:
+        shutil.copyfileobj(codecs.getreader('latin-1')(src), codecs.getwriter('utf-8')(out), BUFFER_SIZE)
+    return 'latin-1'
+
 
 def collect_files_content(parent_dir='.', output_file='collected_content.txt'):
     """
@@ -11,48 +148,65 @@ def collect_files_content(parent_dir='.', output_file='collected_content.txt'):
         output_file (str): The name of the file to save the collected content.
                            Defaults to 'collected_content.txt'.
     """
-    collected_data = []
-    
     # Ensure the parent directory exists
     if not os.path.isdir(parent_dir):
         print(f"Error: Directory '{parent_dir}' not found.")
         return
 
-    print(f"Scanning directory: {os.path.abspath(parent_dir)}")
-    
-    for root, _, files in os.walk(parent_dir):
-        for filename in files:
-            file_path = os.path.join(root, filename)
-            relative_path = os.path.relpath(file_path, parent_dir)
-            
-            # Skip the output file itself if it's in the scanned directory
-            if os.path.abspath(file_path) == os.path.abspath(os.path.join(parent_dir, output_file)):
-                continue
-
-            collected_data.append(f"--- File: {relative_path} ---")
-            try:
-                # Try reading with utf-8, fallback to latin-1 for wider compatibility
-                # Add more encodings or binary handling if needed
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    content = f.read()
-                collected_data.append(content)
-            except UnicodeDecodeError:
-                try:
-                    with open(file_path, 'r', encoding='latin-1') as f:
-                        content = f.read()
-                    collected_data.append(content)
-                    collected_data.append("\n[Note: Read with latin-1 encoding due to UTF-8 decode error]")
-                except Exception as e:
-                    collected_data.append(f"[Error reading file: {e}]")
-            except Exception as e:
-                collected_data.append(f"[Error reading file: {e}]")
-            collected_data.append("-" * (len(relative_path) + 14)) # Separator line
-            collected_data.append("\n") # Add a newline for spacing
-
-    # Write the collected data to the output file
+    # Scanning from the absolute root makes every yielded path absolute and
+    # normalised, so the output file can be excluded by plain string comparison.
+    scan_root = os.path.abspath(parent_dir)
+    excluded_path = os.path.abspath(output_file)
+    print(f"Scanning directory: {scan_root}")
+
+    # Each file's block is written straight to the output as soon as it is read,
+    # so the whole corpus is never held in memory at once.
     try:
-        with open(output_file, 'w', encoding='utf-8') as f:
-            f.write("\n".join(collected_data))
+        with io.BufferedWriter(io.FileIO(output_file, 'w'), buffer_size=BUFFER_SIZE) as out:
+            all_paths = []
+            for file_path in _iter_files(scan_root):
+                # Skip the output file itself (it now exists while we scan)
+                if file_path == excluded_path:
+                    continue
+
+                all_paths.append(file_path)
+
+            # Checking each file is I/O bound, so threads overlap the per-file open/read latency.
+            # Futures are consumed in submission order, keeping the output stable, and at
+            # most max_in_flight reads are pending so only that many small bodies are held.
+            max_workers = min(32, (os.cpu_count() or 1) * 4)
+            max_in_flight = 2 * max_workers
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                paths = iter(all_paths)
+                pending = deque(
+                    (path, pool.submit(_read_one, path, scan_root))
+                    for path in itertools.islice(paths, max_in_flight)
+                )
+                index = 0
+                while pending:
+                    file_path, future = pending.popleft()
+                    relative_path, encoding, message, content = future.result()
+                    for path in itertools.islice(paths, 1):
+                        pending.append((path, pool.submit(_read_one, path, scan_root)))
+
+                    if index:
+                        out.write(b"\n") # Newline between file blocks
+                    index += 1
+                    out.write(f"--- File: {relative_path} ---\n".encode('utf-8'))
+                    if message is None:
+                        try:
+                            if content is not None:
+                                out.write(content)
+                            else:
+                                encoding = _copy_file(file_path, out)
+                            if encoding != 'utf-8':
+                                out.write(b"\n\n[Note: Read with latin-1 encoding due to UTF-8 decode error]")
+                        except OSError as e:
+                            message = f"[Error reading file: {e}]"
+                    if message is not None:
+                        out.write(message.encode('utf-8'))
+                    out.write(("\n" + "-" * (len(relative_path) + 14)).encode('utf-8')) # Separator line
+                    out.write(b"\n\n") # Add a newline for spacing
         print(f"Successfully collected content into '{output_file}'")
     except Exception as e:
         print(f"Error writing to output file '{output_file}': {e}")
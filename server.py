@@ -1,16 +1,23 @@
 import os
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import torch
 from fastapi import FastAPI, HTTPException, Request, Security
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
-from transformers import AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig
+from transformers import AutoTokenizer, AutoModelForCausalLM, AsyncTextIteratorStreamer, BitsAndBytesConfig, StaticCache, StoppingCriteria, StoppingCriteriaList
+from transformers.utils import is_flash_attn_2_available
 from pydantic import BaseModel, Field
 from typing import List, Optional, Dict, Any
 import argparse
 import logging
 import gc
-import json
+import orjson
+import uuid
+import functools
+import math
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -58,6 +65,7 @@ class ChatRequest(BaseModel):
     max_new_tokens: Optional[int] = 512
     temperature: Optional[float] = 0.7
     top_p: Optional[float] = 0.9
+    stream: Optional[bool] = Field(default=False, description="Stream tokens back as Server-Sent Events instead of one JSON answer")
 
 class EmergencyAssessmentRequest(BaseModel):
     # Changed to accept a single prompt matching ApiService
@@ -67,6 +75,7 @@ class EmergencyAssessmentRequest(BaseModel):
     max_new_tokens: Optional[int] = 768 
     temperature: Optional[float] = 0.3 
     top_p: Optional[float] = 0.7
+    stream: Optional[bool] = Field(default=False, description="Stream tokens back as Server-Sent Events instead of one JSON answer")
 
 class ApiResponse(BaseModel):
     answer: str = Field(..., description="The generated response from the model")
@@ -74,7 +83,8 @@ class ApiResponse(BaseModel):
 app = FastAPI(
     title="Medical AI API with Profile Context",
     version="2.4",
-    description=f"Provides endpoints for medical chat and emergency assessment using {HARDCODED_MODEL_ID}, with optional profile context."
+    description=f"Provides endpoints for medical chat and emergency assessment using {HARDCODED_MODEL_ID}, with optional profile context.",
+    default_response_class=ORJSONResponse # orjson encodes much faster than the stdlib json encoder
 )
 
 # --- Security/CORS ---
@@ -94,11 +104,67 @@ model = None
 tokenizer = None
 device = None
 model_id_loaded = None
+engine = None # vLLM AsyncLLMEngine, used instead of `model` with --backend vllm
+SamplingParams = None # vllm.SamplingParams, imported with the engine (vllm is optional and heavy)
+model_compiled = False # True once model.forward is wrapped by torch.compile
+prefix_split_clean = None # Whether the tokenizer splits cleanly after the system turn; checked once per tokenizer
+# Prompt lengths are padded up to one of these so compiled CUDA graphs are reused
+COMPILE_LENGTH_BUCKETS = (512, 1024, 2048, 4096)
+# With --compile, max_new_tokens is capped at this so every static KV cache has the same length
+COMPILE_MAX_NEW_TOKENS = 1024
+# Compiled model only: one StaticCache per padded batch size, reset and reused by every batch of that
+# size. Fresh cache tensors (or a different cache length) would make torch.compile recapture its graphs.
+static_caches: Dict[int, StaticCache] = {}
+# CUDA only: pinned host buffer reused to assemble every batch, the side stream used to
+# upload it, and an event marking when that upload finished. Only the generation worker
+# touches these, one batch at a time.
+staging_buffer = None
+copy_stream = None
+staging_copied = None
+# Serializes loading between the startup warm-up thread and lazy loads from requests
+model_load_lock = threading.Lock()
+
+def _model_is_loaded() -> bool:
+    return tokenizer is not None and (model is not None or engine is not None)
+
+def load_model_and_tokenizer(precision: str, cache_dir: Optional[str], backend: str = "transformers", compile_model: bool = False, quantized_model_id: Optional[str] = None):
+    with model_load_lock:
+        _load_model_and_tokenizer(precision, cache_dir, backend, compile_model, quantized_model_id)
+
+def _bnb_4bit_config() -> BitsAndBytesConfig:
+    return BitsAndBytesConfig(
+        load_in_4bit=True,
+        bnb_4bit_quant_type="nf4",
+        bnb_4bit_compute_dtype=torch.float16
+    )
 
-def load_model_and_tokenizer(precision: str, cache_dir: Optional[str]):
-    global model, tokenizer, device, model_id_loaded
+def _load_vllm_engine(model_id: str, precision: str, cache_dir: Optional[str], quantized_model_id: Optional[str] = None):
+    global SamplingParams
+    try:
+        # Imported here so the default transformers backend never pays for importing vllm
+        from vllm import AsyncEngineArgs, AsyncLLMEngine, SamplingParams
+    except ImportError as e:
+        raise RuntimeError("The vllm backend requires the 'vllm' package (pip install vllm).") from e
+    # Prefix caching reuses the KV cache of the shared system prompt across requests
+    engine_kwargs = {"model": model_id, "download_dir": cache_dir, "trust_remote_code": True, "enable_prefix_caching": True}
+    if precision == "4-bit" and quantized_model_id:
+        # vLLM reads the AWQ/GPTQ method from the checkpoint config and uses its fused int4 kernels
+        logger.info(f"Using pre-quantized 4-bit checkpoint: {quantized_model_id}")
+        engine_kwargs.update(model=quantized_model_id, tokenizer=model_id, dtype="float16")
+    elif precision == "4-bit":
+        logger.info("Configuring 4-bit quantization (vLLM bitsandbytes).")
+        engine_kwargs.update(quantization="bitsandbytes", load_format="bitsandbytes", dtype="float16")
+    elif precision == "16-bit":
+        engine_kwargs["dtype"] = "float16"
+    else: # 32-bit
+        engine_kwargs["dtype"] = "float32"
+    # PagedAttention + continuous batching happen inside the engine, so requests skip gen_queue
+    return AsyncLLMEngine.from_engine_args(AsyncEngineArgs(**engine_kwargs))
+
+def _load_model_and_tokenizer(precision: str, cache_dir: Optional[str], backend: str = "transformers", compile_model: bool = False, quantized_model_id: Optional[str] = None):
+    global model, tokenizer, device, model_id_loaded, engine, model_compiled, prefix_split_clean
     model_id = HARDCODED_MODEL_ID
-    if model is not None and model_id_loaded == model_id:
+    if (model is not None or engine is not None) and model_id_loaded == model_id:
         logger.info(f"Model '{model_id}' is already loaded.")
         return
 
@@ -117,22 +183,38 @@ def load_model_and_tokenizer(precision: str, cache_dir: Optional[str]):
         logger.info("Using CPU.")
         precision = "16-bit" if precision == "4-bit" else precision
 
-    bnb_config = None
     model_kwargs = {"cache_dir": cache_dir, "trust_remote_code": True}
+    weights_id = model_id # Checkpoint the weights come from; the tokenizer always uses model_id
 
-    if precision == "4-bit" and device.type == 'cuda':
+    if precision == "4-bit" and device.type == 'cuda' and quantized_model_id:
+        # AWQ/GPTQ checkpoints ship fused int4 GEMM kernels that decode much faster than bnb nf4
+        logger.info(f"Using pre-quantized 4-bit checkpoint: {quantized_model_id}")
+        weights_id = quantized_model_id
+        model_kwargs["torch_dtype"] = torch.float16
+        # Load straight onto the GPU: GPTQ sets up its ExLlama/Marlin kernels at load time,
+        # and a CPU load followed by .to(device) is a slow full copy for AWQ
+        model_kwargs["device_map"] = {"": device}
+    elif precision == "4-bit" and device.type == 'cuda':
         logger.info("Configuring 4-bit quantization.")
-        bnb_config = BitsAndBytesConfig(
-            load_in_4bit=True,
-            bnb_4bit_quant_type="nf4",
-            bnb_4bit_compute_dtype=torch.float16
-        )
-        model_kwargs["quantization_config"] = bnb_config
+        model_kwargs["quantization_config"] = _bnb_4bit_config()
+    elif precision == "16-bit" and device.type == 'cpu':
+        # x86 CPUs lack native fp16 math (float16 runs slower than float32 there);
+        # bfloat16 is what AVX512-BF16/AMX accelerate.
+        logger.info("Using 16-bit precision (bfloat16 on CPU).")
+        model_kwargs["torch_dtype"] = torch.bfloat16
     elif precision == "16-bit":
         logger.info("Using 16-bit precision (float16).")
         model_kwargs["torch_dtype"] = torch.float16
     else: # 32-bit
         logger.info("Using 32-bit precision (float32).")
+
+    # Fused attention kernels avoid materializing the full attention matrix for long prompts.
+    # FlashAttention-2 needs CUDA, half precision and the optional flash-attn package.
+    if device.type == 'cuda' and precision in ("4-bit", "16-bit") and is_flash_attn_2_available():
+        model_kwargs["attn_implementation"] = "flash_attention_2"
+    else:
+        model_kwargs["attn_implementation"] = "sdpa"
+    logger.info(f"Attention implementation: {model_kwargs['attn_implementation']}")
     try:
         logger.info("Loading tokenizer...");
         tokenizer = AutoTokenizer.from_pretrained(model_id, cache_dir=cache_dir, trust_remote_code=True)
@@ -140,20 +222,45 @@ def load_model_and_tokenizer(precision: str, cache_dir: Optional[str]):
             tokenizer.pad_token = tokenizer.eos_token
         if tokenizer.pad_token_id is None: 
              tokenizer.pad_token_id = tokenizer.eos_token_id
+        # Cached prefixes and the split check belong to the previous tokenizer
+        _system_prompt_prefix.cache_clear()
+        prefix_split_clean = None
         logger.info("Tokenizer loaded.")
     except Exception as e:
         logger.error(f"Tokenizer Loading Error: {e}", exc_info=True)
         raise 
+    if backend == "vllm":
+        try:
+            logger.info("Loading vLLM engine...")
+            engine = _load_vllm_engine(model_id, precision, cache_dir, quantized_model_id)
+            model_id_loaded = model_id
+            logger.info(f"vLLM engine for '{model_id}' ({precision}) loaded successfully.")
+        except Exception as e:
+            logger.error(f"Model Loading Error: {e}", exc_info=True)
+            tokenizer=None; engine=None; model_id_loaded=None
+            raise
+        return
     try:
         logger.info("Loading model...");
-        model = AutoModelForCausalLM.from_pretrained(model_id, **model_kwargs)
+        try:
+            model = AutoModelForCausalLM.from_pretrained(weights_id, **model_kwargs)
+        except Exception as quant_e:
+            if weights_id == model_id:
+                raise
+            logger.warning(f"Could not load pre-quantized checkpoint '{weights_id}': {quant_e}. Falling back to bitsandbytes 4-bit.")
+            model_kwargs.pop("torch_dtype", None)
+            model_kwargs.pop("device_map", None)
+            model_kwargs["quantization_config"] = _bnb_4bit_config()
+            model = AutoModelForCausalLM.from_pretrained(model_id, **model_kwargs)
         model.eval()
         try:
              current_device = next(model.parameters()).device
              logger.info(f"Model parameter check: Device is {current_device}")
-             if current_device != device and not model_kwargs.get("quantization_config"):
+             if current_device != device and not model_kwargs.get("quantization_config") and not model_kwargs.get("device_map"):
                  logger.info(f"Moving model explicitly to target device: {device}")
                  model.to(device)
+             elif model_kwargs.get("device_map") and current_device.type != device.type:
+                 logger.warning(f"Pre-quantized model was placed on {current_device} instead of {device}.")
              elif model_kwargs.get("quantization_config") and current_device.type != 'cuda':
                  logger.warning(f"Quantized model loaded but not on CUDA ({current_device}). Quantization may not be effective.")
              else:
@@ -161,163 +268,571 @@ def load_model_and_tokenizer(precision: str, cache_dir: Optional[str]):
         except Exception as placement_e:
             logger.warning(f"Could not verify final model device placement: {placement_e}")
 
+        if compile_model and device.type == 'cuda':
+            # CUDA graphs remove the per-token Python dispatch overhead during decode.
+            # Compile forward (not the module) so model.generate picks it up; _generate_batch
+            # passes a static KV cache to keep tensor shapes fixed between decode steps.
+            logger.info("Compiling model forward pass (torch.compile, mode=reduce-overhead)...")
+            static_caches.clear()
+            model.forward = torch.compile(model.forward, mode="reduce-overhead", fullgraph=False)
+            model_compiled = True
+        elif compile_model:
+            logger.warning("torch.compile requested but CUDA is unavailable. Skipping compilation.")
+
+        if device.type == 'cpu':
+            # Optional: IPEX routes attention/matmuls through oneDNN (AMX/AVX-512) kernels.
+            # Imported only here, since it is heavy and exits on a torch version mismatch.
+            try:
+                import intel_extension_for_pytorch as ipex
+            except (ImportError, SystemExit) as ipex_e:
+                ipex = None
+                if not isinstance(ipex_e, ImportError):
+                    logger.warning("Intel Extension for PyTorch failed to load (torch version mismatch?). Continuing without it.")
+            if ipex is not None:
+                logger.info("Optimizing model for CPU with Intel Extension for PyTorch...")
+                model = ipex.llm.optimize(model, dtype=model_kwargs.get("torch_dtype", torch.float32))
 
         model_id_loaded = model_id
         logger.info(f"Model '{model_id}' ({precision}) loaded successfully.")
     except Exception as e:
         logger.error(f"Model Loading Error: {e}", exc_info=True)
-        del tokenizer; tokenizer=None; model=None; model_id_loaded=None
+        del tokenizer; tokenizer=None; model=None; model_id_loaded=None; model_compiled=False
+        static_caches.clear()
         gc.collect();
         if torch.cuda.is_available(): torch.cuda.empty_cache()
         raise
 
 
+async def _warm_load_model(cli_args):
+    # Loading takes minutes; run it in a worker thread so the event loop keeps serving /health
+    try:
+        await asyncio.to_thread(load_model_and_tokenizer, cli_args.precision, cli_args.cache_dir, cli_args.backend, cli_args.compile, cli_args.quantized_model_id)
+        app.state.model_ready.set()
+    except Exception as e:
+        logger.error(f"Model preloading failed: {e}", exc_info=True)
+        # Decide if app should exit or continue without preloaded model
+        # raise RuntimeError("Failed to preload model, exiting.") from e
+
+async def _wait_for_model_warmup():
+    # Requests arriving during warm-up wait for it instead of starting a second (blocking) load
+    warmup_task = getattr(app.state, "model_warmup_task", None)
+    if warmup_task is not None and not warmup_task.done():
+        logger.info("Waiting for model warm-up to finish...")
+        await asyncio.shield(warmup_task)
+
 @app.on_event("startup")
 async def startup_event():
     logger.info("Application startup...")
     app.state.cli_args_parsed = args # Make sure 'args' is accessible here or passed differently
+    app.state.model_ready = asyncio.Event()
+    app.state.model_warmup_task = None
+    # All generation goes through one queue and worker so model.generate never runs concurrently
+    app.state.gen_queue = asyncio.Queue()
+    # model.generate always runs on this one thread: torch.compile's CUDA graphs and the
+    # current CUDA stream are per thread, so a shared pool would re-capture graphs
+    app.state.gen_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="generation")
+    app.state.gen_worker_task = asyncio.create_task(_generation_worker())
     if args.preload:
-        logger.info(f"Preloading model '{HARDCODED_MODEL_ID}'...")
-        try:
-            load_model_and_tokenizer(args.precision, args.cache_dir)
-        except Exception as e:
-            logger.error(f"Model preloading failed: {e}", exc_info=True)
-            # Decide if app should exit or continue without preloaded model
-            # raise RuntimeError("Failed to preload model, exiting.") from e
+        logger.info(f"Preloading model '{HARDCODED_MODEL_ID}' in the background...")
+        app.state.model_warmup_task = asyncio.create_task(_warm_load_model(args))
     else:
         logger.info("Model preloading disabled. Model will load on first request.")
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    app.state.gen_worker_task.cancel()
+    app.state.gen_executor.shutdown(wait=False, cancel_futures=True)
+
 # --- Health Check ---
 @app.get("/health")
 async def health_check():
     # More informative health check
     model_status = "not loaded"
     active_model_id = "None"
-    if model is not None and tokenizer is not None:
+    warmup_task = app.state.model_warmup_task
+    if app.state.model_ready.is_set() and _model_is_loaded():
          model_status = "loaded"
          active_model_id = model_id_loaded
+    elif warmup_task is not None and not warmup_task.done():
+         model_status = "loading" # Lets readiness probes tell warm-up apart from serving
     # Could add a quick inference test here if needed, but keep it fast
-    return JSONResponse(content={
+    return ORJSONResponse(content={
         "status": "healthy",
         "model_status": model_status,
         "model_id": active_model_id
     })
 
 # --- Reusable Generation Function (Handles Profile Context) ---
-def _generate_response(
+# (UserProfile attribute, label) pairs rendered into the profile context, in order.
+# Add ('weight_kg', 'Weight (kg)'), ('height_cm', 'Height (cm)'), ('blood_type', 'Blood Type') if needed.
+_PROFILE_FIELDS = (
+    ('age', 'Age'),
+    ('gender', 'Gender'),
+    ('conditions', 'Known Conditions'),
+    ('allergies', 'Known Allergies'),
+    ('medications', 'Current Medications'),
+)
+
+def _build_system_prompt(
     system_prompt_base: str,
+    profile: Optional[UserProfile] # Profile model from the request, read directly
+) -> str:
+    """Prepends the user's profile context (if any) to the base system prompt."""
+    if profile is None:
+        return system_prompt_base
+    # Hashable snapshot of the fields used, so repeat users hit the cache below
+    profile_values = tuple(
+        tuple(value) if isinstance(value, list) else value
+        for value in (getattr(profile, attr) for attr, _ in _PROFILE_FIELDS)
+    )
+    return _format_system_prompt(system_prompt_base, profile_values)
+
+@functools.lru_cache(maxsize=256)
+def _format_system_prompt(system_prompt_base: str, profile_values: tuple) -> str:
+    # Add non-empty/non-null profile fields clearly
+    profile_parts = [
+        f"- {label}: {', '.join(value) if isinstance(value, tuple) else value}"
+        for (_, label), value in zip(_PROFILE_FIELDS, profile_values) if value
+    ]
+    if not profile_parts:
+        return system_prompt_base
+
+    profile_str = "User Profile:\n" + "\n".join(profile_parts)
+    # Prepend profile context to the system prompt
+    system_prompt = profile_str.strip() + "\n\n" + system_prompt_base
+
+    # Uncomment below for debugging the exact prompt being sent
+    # logger.debug(f"Effective System Prompt:\n----\n{system_prompt}\n----")
+    return system_prompt
+
+def _build_prompt(
+    system_prompt: str,
     user_content: str,
-    history_list: List[Dict[str, str]],
-    gen_params: Dict[str, Any],
-    profile_data: Optional[Dict[str, Any]] # Profile data as dict
-):
-    global model, tokenizer, device
-    if model is None or tokenizer is None:
-        logger.warning("Model lazy load trigger...")
-        cli_args = app.state.cli_args_parsed # Access args from app state
-        try:
-            load_model_and_tokenizer(cli_args.precision, cli_args.cache_dir)
-        except Exception as e:
-            # Use 503 Service Unavailable for model loading issues
-            raise HTTPException(status_code=503, detail=f"Model service temporarily unavailable: {e}")
-
-    try:
-        system_prompt = system_prompt_base 
-        profile_context_added = False
-        if profile_data:
-            profile_parts = []
-            # Add non-empty/non-null profile fields clearly
-            if profile_data.get('age'): profile_parts.append(f"- Age: {profile_data['age']}")
-            if profile_data.get('gender'): profile_parts.append(f"- Gender: {profile_data['gender']}")
-            if profile_data.get('conditions'): profile_parts.append(f"- Known Conditions: {', '.join(profile_data['conditions'])}")
-            if profile_data.get('allergies'): profile_parts.append(f"- Known Allergies: {', '.join(profile_data['allergies'])}")
-            if profile_data.get('medications'): profile_parts.append(f"- Current Medications: {', '.join(profile_data['medications'])}")
-            # Add weight/height/blood_type if present and needed
-            # if profile_data.get('weight_kg'): profile_parts.append(f"- Weight: {profile_data['weight_kg']} kg")
-            # if profile_data.get('height_cm'): profile_parts.append(f"- Height: {profile_data['height_cm']} cm")
-            # if profile_data.get('blood_type'): profile_parts.append(f"- Blood Type: {profile_data['blood_type']}")
-
-            if profile_parts:
-                 profile_str = "User Profile:\n" + "\n".join(profile_parts)
-                 # Prepend profile context to the system prompt
-                 system_prompt = profile_str.strip() + "\n\n" + system_prompt_base
-                 profile_context_added = True
-
-        # logger.info(f"Using profile context: {profile_context_added}")
-        # Uncomment below for debugging the exact prompt being sent
-        # logger.debug(f"Effective System Prompt:\n----\n{system_prompt}\n----")
-        # --- End Profile Incorporation ---
-
-        # 1. Construct messages list for the chat template
-        messages = [{"role": "system", "content": system_prompt}] + history_list + [{"role": "user", "content": user_content}]
-
-        # 2. Apply the chat template
-        # Important: Ensure add_generation_prompt=True for inference
-        prompt_formatted = tokenizer.apply_chat_template(
-            messages,
+    history_list: List[Dict[str, str]]
+) -> str:
+    """Renders the chat template for the system prompt, history and current user turn."""
+    # 1. Construct messages list for the chat template
+    messages = [{"role": "system", "content": system_prompt}] + history_list + [{"role": "user", "content": user_content}]
+
+    # 2. Apply the chat template
+    # Important: Ensure add_generation_prompt=True for inference
+    prompt_formatted = tokenizer.apply_chat_template(
+        messages,
+        tokenize=False,
+        add_generation_prompt=True
+    )
+    # logger.debug(f"Formatted Prompt for Model:\n----\n{prompt_formatted}\n----")
+    return prompt_formatted
+
+def _prefix_splits_cleanly() -> bool:
+    """
+    Checks once per loaded tokenizer that tokenizing the system-turn prefix and
+    the rest of the prompt separately gives the same ids as tokenizing it whole.
+    If not, system prompt ids are never cached and every prompt is tokenized in full.
+    """
+    global prefix_split_clean
+    if prefix_split_clean is None:
+        system_prompt = "You are a helpful assistant."
+        prefix_text = tokenizer.apply_chat_template(
+            [{"role": "system", "content": system_prompt}],
             tokenize=False,
-            add_generation_prompt=True
+            add_generation_prompt=False
         )
-        # logger.debug(f"Formatted Prompt for Model:\n----\n{prompt_formatted}\n----")
-
+        sample_prompt = _build_prompt(system_prompt, "Hello", [])
+        clean = sample_prompt.startswith(prefix_text)
+        if clean:
+            prefix_ids = tokenizer(prefix_text, return_tensors="pt")["input_ids"][0]
+            full_ids = tokenizer(sample_prompt, return_tensors="pt")["input_ids"][0]
+            suffix_ids = tokenizer(sample_prompt[len(prefix_text):], return_tensors="pt", add_special_tokens=False)["input_ids"][0]
+            clean = torch.equal(full_ids, torch.cat([prefix_ids, suffix_ids]))
+        if not clean:
+            logger.info("Tokenizer does not split cleanly after the system turn; system prompt ids will not be cached.")
+        prefix_split_clean = clean
+    return prefix_split_clean
+
+@functools.lru_cache(maxsize=256)
+def _system_prompt_prefix(system_prompt: str):
+    """
+    Renders and tokenizes the chat-template prefix for a system prompt once, so
+    requests sharing it (the static prompts, or a returning user's profile) only
+    tokenize their own history and user turn. Only used if _prefix_splits_cleanly().
+
+    Returns (prefix_text, prefix_ids).
+    """
+    prefix_text = tokenizer.apply_chat_template(
+        [{"role": "system", "content": system_prompt}],
+        tokenize=False,
+        add_generation_prompt=False
+    )
+    prefix_ids = tokenizer(prefix_text, return_tensors="pt")["input_ids"][0]
+    return prefix_text, prefix_ids
 
-        # 3. Tokenize the formatted prompt
-        # No padding needed for single sequence generation usually
+def _prepare_generation(
+    system_prompt_base: str,
+    user_content: str,
+    history_list: List[Dict[str, str]],
+    gen_params: Dict[str, Any],
+    profile: Optional[UserProfile] # Profile model from the request, read directly
+):
+    """Builds the prompt token ids and generation config for one request."""
+    system_prompt = _build_system_prompt(system_prompt_base, profile)
+    prompt_formatted = _build_prompt(system_prompt, user_content, history_list)
+
+    # 3. Tokenize the formatted prompt
+    # No padding here; sequences are padded together when the batch is assembled
+    cached_prefix = _system_prompt_prefix(system_prompt) if _prefix_splits_cleanly() else None
+    if cached_prefix is not None and prompt_formatted.startswith(cached_prefix[0]):
+        # Only the history + user turn needs tokenizing; the system prefix ids are reused
+        prefix_text, prefix_ids = cached_prefix
+        suffix_ids = tokenizer(prompt_formatted[len(prefix_text):], return_tensors="pt", add_special_tokens=False)["input_ids"][0]
+        input_ids = torch.cat([prefix_ids, suffix_ids])[:4096] # Same truncation as the full tokenizer call
+    else:
         inputs = tokenizer(prompt_formatted, return_tensors="pt", truncation=True, padding=False, max_length=4096) # Increased context
-        input_ids = inputs["input_ids"].to(device)
-        attention_mask = inputs["attention_mask"].to(device) if "attention_mask" in inputs else torch.ones_like(input_ids).to(device)
-        input_length = input_ids.shape[1] # Length of the input prompt tokens
+        input_ids = inputs["input_ids"][0]
+    # No attention mask per request: an unpadded prompt attends to every token, and
+    # _generate_batch derives the batch mask from the prompt lengths.
+
+    # 4. Prepare generation configuration
+    generation_config = {
+        "max_new_tokens": gen_params.get('max_new_tokens', 512),
+        "eos_token_id": tokenizer.eos_token_id,
+        "pad_token_id": tokenizer.pad_token_id, # Crucial for stopping criteria
+        "use_cache": True, # Essential for faster generation
+        # Add other params from request or defaults
+        "temperature": gen_params.get('temperature', 0.7),
+        "top_p": gen_params.get('top_p', 0.9),
+        # "top_k": gen_params.get('top_k', 50), # Add if needed
+        "do_sample": True, # Enable sampling based on temp/top_p
+    }
 
-        # 4. Prepare generation configuration
+    # Ensure do_sample is True if temp/top_p/top_k are set for sampling
+    if generation_config["temperature"] <= 0.0 and generation_config["top_p"] >= 1.0:
+         generation_config["do_sample"] = False # Use greedy search if temp=0, top_p=1
+         # Remove sampling parameters if not doing sampling
+         generation_config.pop("temperature", None)
+         generation_config.pop("top_p", None)
+         # generation_config.pop("top_k", None)
+
+    return input_ids, generation_config
+
+def _staging_tensor(shape, dtype) -> torch.Tensor:
+    """Returns a contiguous host tensor to assemble a batch in; pinned and reused on CUDA."""
+    global staging_buffer
+    if device.type != 'cuda':
+        return torch.empty(shape, dtype=dtype)
+    if staging_copied is not None:
+        staging_copied.synchronize() # The previous upload may still be reading the buffer
+    numel = math.prod(shape)
+    if staging_buffer is None or staging_buffer.numel() < numel or staging_buffer.dtype != dtype:
+        staging_buffer = torch.empty(numel, dtype=dtype).pin_memory()
+    return staging_buffer[:numel].view(shape)
+
+def _upload_to_device(host_tensor: torch.Tensor) -> torch.Tensor:
+    """Copies a host tensor to the model device, asynchronously on a side stream for CUDA."""
+    global copy_stream, staging_copied
+    if device.type != 'cuda':
+        return host_tensor.to(device)
+    if copy_stream is None:
+        copy_stream = torch.cuda.Stream(device)
+        staging_copied = torch.cuda.Event()
+    compute_stream = torch.cuda.current_stream(device)
+    with torch.cuda.stream(copy_stream):
+        device_tensor = host_tensor.to(device, non_blocking=True) # Async only from pinned memory
+        staging_copied.record(copy_stream)
+    compute_stream.wait_stream(copy_stream) # generate must not read the tensor before it lands
+    device_tensor.record_stream(compute_stream)
+    return device_tensor
+
+class _StopWhenCancelled(StoppingCriteria):
+    """Ends generation early once the request's future is cancelled (its client went away)."""
+    def __init__(self, future: asyncio.Future):
+        self.future = future
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        return torch.full((input_ids.shape[0],), self.future.cancelled(), dtype=torch.bool, device=input_ids.device)
+
+def _static_cache(batch_size: int) -> StaticCache:
+    """Returns the reset static KV cache for a padded batch size, allocating it on first use."""
+    cache = static_caches.get(batch_size)
+    if cache is None:
+        cache = static_caches[batch_size] = StaticCache(
+            config=model.config,
+            max_batch_size=batch_size,
+            max_cache_len=COMPILE_LENGTH_BUCKETS[-1] + COMPILE_MAX_NEW_TOKENS,
+            device=model.device,
+            dtype=model.dtype
+        )
+    else:
+        cache.reset()
+    return cache
+
+@torch.inference_mode() # Cheaper than no_grad: no autograd or version-counter tracking at all
+def _generate_batch(
+    input_ids_list: List[torch.Tensor],
+    generation_config: Dict[str, Any],
+    streamer: Optional[AsyncTextIteratorStreamer] = None,
+    stopping_criteria: Optional[StoppingCriteriaList] = None
+) -> List[str]:
+    """Runs one model.generate call for several prompts sharing the same generation config."""
+    # Left-pad to a common length: decoder-only models continue from the last position
+    batch_size = len(input_ids_list)
+    padded_batch_size = batch_size
+    input_length = max(ids.shape[0] for ids in input_ids_list)
+    if model_compiled:
+        # Bucket the padded length and batch size so the compiled graph is reused instead of recompiled
+        input_length = next((bucket for bucket in COMPILE_LENGTH_BUCKETS if bucket >= input_length), input_length)
+        padded_batch_size = 1 << (batch_size - 1).bit_length()
         generation_config = {
-            "max_new_tokens": gen_params.get('max_new_tokens', 512),
-            "eos_token_id": tokenizer.eos_token_id,
-            "pad_token_id": tokenizer.pad_token_id, # Crucial for stopping criteria
-            "use_cache": True, # Essential for faster generation
-            # Add other params from request or defaults
-            "temperature": gen_params.get('temperature', 0.7),
-            "top_p": gen_params.get('top_p', 0.9),
-            # "top_k": gen_params.get('top_k', 50), # Add if needed
-            "do_sample": True, # Enable sampling based on temp/top_p
+            **generation_config,
+            "max_new_tokens": min(generation_config["max_new_tokens"], COMPILE_MAX_NEW_TOKENS),
+            "past_key_values": _static_cache(padded_batch_size),
         }
+    # Ids and mask share one staging tensor so they go to the device in a single copy
+    batch = _staging_tensor((2, padded_batch_size, input_length), input_ids_list[0].dtype)
+    batch[0].fill_(tokenizer.pad_token_id)
+    batch[1].zero_()
+    for i, ids in enumerate(input_ids_list):
+        batch[0, i, input_length - ids.shape[0]:] = ids
+        batch[1, i, input_length - ids.shape[0]:] = 1
+    # Filler rows repeat the first prompt (a fully masked row can produce NaN logits); their output is dropped
+    batch[:, batch_size:] = batch[:, :1]
+    input_ids, attention_mask = _upload_to_device(batch).unbind(0)
+
+    logger.info(f"Generating {batch_size} response(s) (max_new_tokens={generation_config['max_new_tokens']}, do_sample={generation_config['do_sample']})...")
+
+    # 5. Generate response tokens
+    outputs = model.generate(
+        input_ids=input_ids,
+        attention_mask=attention_mask, # Pass attention mask
+        streamer=streamer, # Receives text as it is decoded (single-sequence batches only)
+        stopping_criteria=stopping_criteria,
+        **generation_config
+    )
+    logger.info("Generation complete.")
 
-        # Ensure do_sample is True if temp/top_p/top_k are set for sampling
-        if generation_config["temperature"] <= 0.0 and generation_config["top_p"] >= 1.0:
-             generation_config["do_sample"] = False # Use greedy search if temp=0, top_p=1
-             # Remove sampling parameters if not doing sampling
-             generation_config.pop("temperature", None)
-             generation_config.pop("top_p", None)
-             # generation_config.pop("top_k", None)
-
-
-        logger.info(f"Generating response (max_new_tokens={generation_config['max_new_tokens']}, do_sample={generation_config['do_sample']})...")
-
-        # 5. Generate response tokens
-        with torch.no_grad():
-            outputs = model.generate(
-                input_ids=input_ids,
-                attention_mask=attention_mask, # Pass attention mask
-                **generation_config
-            )
-        logger.info("Generation complete.")
-
-        # 6. Decode only the newly generated tokens
-        newly_generated_token_ids = outputs[0][input_length:]
-        assistant_response = tokenizer.decode(newly_generated_token_ids, skip_special_tokens=True).strip()
+    # 6. Decode only the newly generated tokens
+    responses = []
+    for output in outputs[:batch_size]:
+        assistant_response = tokenizer.decode(output[input_length:], skip_special_tokens=True).strip()
 
         # Uncomment for debugging raw output
         # logger.debug(f"Raw model output:\n----\n{assistant_response}\n----")
 
         # Optional: Add post-processing to clean up response if needed
         # assistant_response = assistant_response.replace("Assistant:", "").strip()
+        responses.append(assistant_response)
+
+    return responses
+
+async def _generation_worker():
+    """
+    Single consumer of app.state.gen_queue. Collects pending requests for up to
+    --batch-wait-ms (at most --max-batch-size of them) and runs each group with
+    identical generation settings through one batched model.generate call, so
+    concurrent users share the GPU instead of racing for it.
+    """
+    queue = app.state.gen_queue
+    cli_args = app.state.cli_args_parsed
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await queue.get()]
+        try:
+            await _run_batch(batch, queue, cli_args, loop)
+        except Exception as e:
+            # Anything failing outside model.generate must not kill the only consumer of the queue
+            logger.error(f"Error in generation worker: {e}", exc_info=True)
+            _fail_jobs(batch, e)
+
+def _fail_jobs(jobs: list, error: Exception):
+    """Fails every pending job with a 500 and unblocks its streamer, if any."""
+    # Use 500 Internal Server Error for generation failures
+    for job in jobs:
+        if job[2].done():
+            continue # Already answered, or its client went away
+        job[2].set_exception(HTTPException(status_code=500, detail=f"Error generating response: {error}"))
+        if job[3] is not None:
+            job[3].end() # Unblock the client's stream; the error comes from the future
+
+async def _run_batch(batch: list, queue: asyncio.Queue, cli_args, loop: asyncio.AbstractEventLoop):
+    """Tops up a batch from the queue for up to --batch-wait-ms, then generates each group in it."""
+    deadline = loop.time() + cli_args.batch_wait_ms / 1000
+    while len(batch) < cli_args.max_batch_size:
+        timeout = deadline - loop.time()
+        if timeout <= 0:
+            break
+        try:
+            batch.append(await asyncio.wait_for(queue.get(), timeout))
+        except asyncio.TimeoutError:
+            break
+
+    # model.generate takes one config per call, so only matching requests are batched together.
+    # Streamers handle a single sequence, so streaming requests always run on their own.
+    groups: Dict[Any, list] = {}
+    for job in batch:
+        key = id(job) if job[3] is not None else tuple(sorted(job[1].items()))
+        groups.setdefault(key, []).append(job)
+
+    for jobs in groups.values():
+        jobs = [job for job in jobs if not job[2].done()] # Skip requests whose client went away
+        if not jobs:
+            continue
+        try:
+            answers = await loop.run_in_executor(
+                app.state.gen_executor,
+                _generate_batch,
+                [job[0] for job in jobs],
+                jobs[0][1],
+                jobs[0][3],
+                # A streaming job runs alone, so it can stop as soon as its client disconnects
+                StoppingCriteriaList([_StopWhenCancelled(jobs[0][2])]) if jobs[0][3] is not None else None
+            )
+        except Exception as e:
+            logger.error(f"Error during generation: {e}", exc_info=True)
+            _fail_jobs(jobs, e)
+            continue
+        for job, answer in zip(jobs, answers):
+            if not job[2].done():
+                job[2].set_result(answer)
+
+def _vllm_generate(
+    system_prompt_base: str,
+    user_content: str,
+    history_list: List[Dict[str, str]],
+    gen_params: Dict[str, Any],
+    profile: Optional[UserProfile]
+):
+    """Starts a vLLM request; yields RequestOutputs whose text grows as tokens are produced."""
+    system_prompt = _build_system_prompt(system_prompt_base, profile)
+    prompt_formatted = _build_prompt(system_prompt, user_content, history_list)
+    sampling_params = SamplingParams(
+        max_tokens=gen_params.get('max_new_tokens', 512),
+        temperature=gen_params.get('temperature', 0.7), # 0 means greedy, as with the transformers backend
+        top_p=gen_params.get('top_p', 0.9),
+        # Same 4096-token limit as the transformers path, but vLLM keeps the *last* 4096
+        # prompt tokens (left truncation), while the tokenizer there keeps the first 4096
+        truncate_prompt_tokens=4096
+    )
+    logger.info(f"Generating response with vLLM (max_tokens={sampling_params.max_tokens})...")
+    return engine.generate(prompt_formatted, sampling_params, uuid.uuid4().hex)
 
-        return assistant_response
-
+async def _generate_response_vllm(
+    system_prompt_base: str,
+    user_content: str,
+    history_list: List[Dict[str, str]],
+    gen_params: Dict[str, Any],
+    profile: Optional[UserProfile]
+):
+    try:
+        final_output = None
+        async for request_output in _vllm_generate(system_prompt_base, user_content, history_list, gen_params, profile):
+            final_output = request_output
+        logger.info("Generation complete.")
+        return final_output.outputs[0].text.strip()
     except Exception as e:
         logger.error(f"Error during generation: {e}", exc_info=True)
         # Use 500 Internal Server Error for generation failures
         raise HTTPException(status_code=500, detail=f"Error generating response: {e}")
 
+async def _ensure_model_loaded():
+    if not _model_is_loaded():
+        logger.warning("Model lazy load trigger...")
+        cli_args = app.state.cli_args_parsed # Access args from app state
+        try:
+            await asyncio.to_thread(load_model_and_tokenizer, cli_args.precision, cli_args.cache_dir, cli_args.backend, cli_args.compile, cli_args.quantized_model_id)
+            app.state.model_ready.set()
+        except Exception as e:
+            # Use 503 Service Unavailable for model loading issues
+            raise HTTPException(status_code=503, detail=f"Model service temporarily unavailable: {e}")
+
+async def _submit_generation(
+    system_prompt_base: str,
+    user_content: str,
+    history_list: List[Dict[str, str]],
+    gen_params: Dict[str, Any],
+    profile: Optional[UserProfile],
+    streamer: Optional[AsyncTextIteratorStreamer] = None
+) -> asyncio.Future:
+    """Queues a request for the generation worker; the future resolves to the full answer."""
+    try:
+        input_ids, generation_config = _prepare_generation(
+            system_prompt_base, user_content, history_list, gen_params, profile
+        )
+    except Exception as e:
+        logger.error(f"Error preparing generation inputs: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Error generating response: {e}")
+
+    future = asyncio.get_running_loop().create_future()
+    await app.state.gen_queue.put((input_ids, generation_config, future, streamer))
+    return future
+
+async def _generate_response(
+    system_prompt_base: str,
+    user_content: str,
+    history_list: List[Dict[str, str]],
+    gen_params: Dict[str, Any],
+    profile: Optional[UserProfile] # Profile model from the request, read directly
+):
+    await _ensure_model_loaded()
+
+    if engine is not None:
+        return await _generate_response_vllm(system_prompt_base, user_content, history_list, gen_params, profile)
+
+    # Hand the request to the generation worker and wait for its slice of the batch
+    future = await _submit_generation(system_prompt_base, user_content, history_list, gen_params, profile)
+    return await future
+
+def _sse_event(payload: Dict[str, Any]) -> str:
+    return f"data: {orjson.dumps(payload).decode()}\n\n"
+
+async def _stream_response(
+    system_prompt_base: str,
+    user_content: str,
+    history_list: List[Dict[str, str]],
+    gen_params: Dict[str, Any],
+    profile: Optional[UserProfile]
+):
+    """
+    Starts generation and returns an async iterator of Server-Sent Events:
+    one {"token": ...} event per decoded text chunk, then "[DONE]". A failure after
+    streaming has begun is reported as an {"error": ...} event, since the HTTP
+    status has already been sent. Loading and input errors still raise HTTPException.
+    """
+    await _ensure_model_loaded()
+
+    if engine is not None:
+        async def vllm_events():
+            sent = 0
+            try:
+                async for request_output in _vllm_generate(system_prompt_base, user_content, history_list, gen_params, profile):
+                    text = request_output.outputs[0].text # Cumulative; send only the new part
+                    if len(text) > sent:
+                        yield _sse_event({"token": text[sent:]})
+                        sent = len(text)
+                logger.info("Generation complete.")
+            except Exception as e:
+                logger.error(f"Error during generation: {e}", exc_info=True)
+                yield _sse_event({"error": f"Error generating response: {e}"})
+                return
+            yield "data: [DONE]\n\n"
+        return vllm_events()
+
+    streamer = AsyncTextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+    future = await _submit_generation(system_prompt_base, user_content, history_list, gen_params, profile, streamer)
+
+    async def events():
+        try:
+            async for text in streamer:
+                if text:
+                    yield _sse_event({"token": text})
+            await future # Surfaces a generation error raised after the streamer was closed
+        except HTTPException as e:
+            yield _sse_event({"error": e.detail})
+            return
+        finally:
+            future.cancel() # No-op once finished; otherwise skips the queued job or stops its generate call
+        yield "data: [DONE]\n\n"
+    return events()
+
 
 # --- Chat Endpoint ---
 @app.post("/chat", response_model=ApiResponse)
@@ -325,9 +840,11 @@ async def chat(request: ChatRequest): # Unsecured for now
     # Log basic info, avoid logging sensitive prompt/profile details unless debugging
     profile_was_provided = request.user_profile is not None
     logger.info(f"/chat called. History: {len(request.history)} turns. Profile provided: {profile_was_provided}")
+    await _wait_for_model_warmup()
 
     # Prepare history list
-    history_dict_list = [msg.model_dump() for msg in request.history] # Use model_dump
+    # Plain attribute access; model_dump walks the whole schema for two string fields
+    history_dict_list = [{"role": msg.role, "content": msg.content} for msg in request.history]
 
     # Prepare generation parameters
     gen_params = {
@@ -336,16 +853,23 @@ async def chat(request: ChatRequest): # Unsecured for now
         "top_p": request.top_p
     }
 
-    # Prepare profile dictionary (handle potential None)
-    profile_dict = request.user_profile.model_dump(exclude_unset=True) if profile_was_provided else None
+    if request.stream:
+        events = await _stream_response(
+            system_prompt_base=CHAT_SYSTEM_PROMPT,
+            user_content=request.prompt,
+            history_list=history_dict_list,
+            gen_params=gen_params,
+            profile=request.user_profile
+        )
+        return StreamingResponse(events, media_type="text/event-stream")
 
     # Call the reusable generation function
-    answer = _generate_response(
+    answer = await _generate_response(
         system_prompt_base=CHAT_SYSTEM_PROMPT,
         user_content=request.prompt,
         history_list=history_dict_list,
         gen_params=gen_params,
-        profile_data=profile_dict
+        profile=request.user_profile
     )
     return ApiResponse(answer=answer)
 
@@ -355,6 +879,7 @@ async def emergency_assessment(request: EmergencyAssessmentRequest): # Unsecured
     # Log basic info
     profile_was_provided = request.user_profile is not None
     logger.info(f"/emergency_assessment called. Profile provided: {profile_was_provided}")
+    await _wait_for_model_warmup()
     # Avoid logging the full prompt by default unless debugging
     # logger.debug(f"Emergency prompt received: {request.prompt}")
 
@@ -365,17 +890,24 @@ async def emergency_assessment(request: EmergencyAssessmentRequest): # Unsecured
         "top_p": request.top_p
     }
 
-    # Prepare profile dictionary
-    profile_dict = request.user_profile.model_dump(exclude_unset=True) if profile_was_provided else None
+    if request.stream:
+        events = await _stream_response(
+            system_prompt_base=EMERGENCY_SYSTEM_PROMPT,
+            user_content=request.prompt,
+            history_list=[],
+            gen_params=gen_params,
+            profile=request.user_profile
+        )
+        return StreamingResponse(events, media_type="text/event-stream")
 
     # Call the reusable generation function with the specific emergency prompt
     # The user_content is the full prompt received from the client
-    answer = _generate_response(
+    answer = await _generate_response(
         system_prompt_base=EMERGENCY_SYSTEM_PROMPT,
         user_content=request.prompt, # Use the prompt directly
         history_list=[], # No history for emergency assessment
         gen_params=gen_params,
-        profile_data=profile_dict
+        profile=request.user_profile
     )
     return ApiResponse(answer=answer)
 
@@ -386,8 +918,13 @@ if __name__ == "__main__":
     parser.add_argument("--host", type=str, default="0.0.0.0", help="Host IP to bind to (0.0.0.0 for all interfaces)")
     parser.add_argument("--port", type=int, default=8000, help="Port to listen on")
     parser.add_argument("--precision", type=str, choices=["4-bit", "16-bit", "32-bit"], default="4-bit", help="Model loading precision (4-bit requires CUDA and bitsandbytes)")
+    parser.add_argument("--quantized-model-id", type=str, default=None, help="Pre-quantized AWQ/GPTQ checkpoint of the model to use for 4-bit precision instead of bitsandbytes nf4 (optional)")
     parser.add_argument("--cache-dir", type=str, default=None, help="Hugging Face cache directory (optional)")
     parser.add_argument("--preload", action="store_true", help="Preload the model on startup")
+    parser.add_argument("--backend", type=str, choices=["transformers", "vllm"], default="transformers", help="Inference engine (vllm adds PagedAttention and continuous batching; requires the vllm package)")
+    parser.add_argument("--compile", action="store_true", help="Compile the model forward pass with torch.compile (CUDA only; the first requests are slow while graphs are captured, and max_new_tokens is capped at 1024)")
+    parser.add_argument("--max-batch-size", type=int, default=8, help="Maximum number of queued requests combined into one generate call")
+    parser.add_argument("--batch-wait-ms", type=float, default=10.0, help="How long to wait for more requests before running a batch (milliseconds)")
     parser.add_argument("--workers", type=int, default=1, help="Number of Uvicorn workers (MUST be 1 for stateful models)", choices=[1])
     args = parser.parse_args()
 
@@ -397,6 +934,8 @@ if __name__ == "__main__":
     logger.info(f"Starting Uvicorn server on {args.host}:{args.port}")
     logger.info(f"Using Model: {HARDCODED_MODEL_ID}")
     logger.info(f"Precision: {args.precision}")
+    logger.info(f"Backend: {args.backend}")
+    if args.quantized_model_id: logger.info(f"Quantized Checkpoint: {args.quantized_model_id}")
     if args.cache_dir: logger.info(f"Cache Directory: {args.cache_dir}")
     logger.info(f"Preload Model: {'Enabled' if args.preload else 'Disabled'}")
     logger.warning("CORS enabled for specified origins. Review for production deployment.")